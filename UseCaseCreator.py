@@ -1,56 +1,139 @@
 import matplotlib.pyplot as plt
-import networkx as nx
 import gradio as gr
-from matplotlib.patches import Ellipse
-import math
-
-def adjust_arrow_positions(pos, edge, width=400, height=160):
+from collections import OrderedDict, defaultdict, deque
+from matplotlib.cbook import is_math_text
+from matplotlib.collections import EllipseCollection, LineCollection, PatchCollection
+from matplotlib.font_manager import FontProperties
+from matplotlib.patches import FancyArrow
+import numpy as np
+import re
+import threading
+import warnings
+
+# Matches the relationship arrow in a line, trying the dashed form first
+EDGE_PATTERN = re.compile(r"(-->|->)")
+
+# Figure and axes shared by every diagram, cleared and resized per call instead of recreated
+_FIG = plt.figure(figsize=(1, 1))
+_AX = _FIG.add_subplot(111)
+_FIG_LOCK = threading.Lock()
+
+def iter_lines(text):
+    """
+    Yields the lines of the text one at a time, slicing each out of the string instead of copying it whole.
+    """
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start)
+        if end == -1:
+            end = len(text)
+        yield text[start:end]
+        start = end + 1
+
+def adjust_arrow_positions(sources, targets, width=400, height=160):
     """
     Adjusts arrow positions so they start and end at the edges of the ellipses.
+    Takes (N, 2) arrays of source and target positions and returns (N, 2) arrays of start points,
+    end points and the unit direction of each drawn segment.
     """
-    x1, y1 = pos[edge[0]]  # Source position
-    x2, y2 = pos[edge[1]]  # Target position
+    deltas = targets - sources
 
-    # Compute angle of the line connecting source and target
-    angle = math.atan2(y2 - y1, x2 - x1)
+    # Compute angle of the line connecting each source and target
+    angles = np.arctan2(deltas[:, 1], deltas[:, 0])
 
-    # Adjust positions to the edge of the ellipses
-    x1_adjusted = x1 + (width / 2) * math.cos(angle)
-    y1_adjusted = y1 + (height / 2) * math.sin(angle)
+    # Offsets from the ellipse centers to their edges
+    offsets = 0.5 * np.array([width, height]) * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+    starts = sources + offsets
+    ends = targets - offsets
 
-    x2_adjusted = x2 - (width / 2) * math.cos(angle)
-    y2_adjusted = y2 - (height / 2) * math.sin(angle)
+    # The ellipses are wider than tall, so the segment is not parallel to the center-to-center
+    # line on diagonal edges; normalize the segment itself so arrowheads follow the drawn line
+    segments = ends - starts
+    directions = segments / np.hypot(segments[:, 0], segments[:, 1])[:, None]
 
-    return (x1_adjusted, y1_adjusted), (x2_adjusted, y2_adjusted)
+    return starts, ends, directions
 
-def fit_text_in_ellipse(ax, text, x, y, ellipse_width, font_size=12, min_font_size=8, decrement_step=0.5):
-    """
-    Dynamically scales the font size to fit the text within the ellipse.
-    """
-    temp_text = ax.text(x, y, text, ha="center", va="center", fontsize=font_size, fontweight="bold")
-    renderer = ax.figure.canvas.get_renderer()
+# Set to True to re-measure each label after sizing and warn about any that still overflow
+VERIFY_TEXT_FIT = False
+
+# Widest printable ASCII glyph in the default bold font ("W"), as a fraction of the font size
+MAX_CHAR_WIDTH_EM = 1.1
 
-    while temp_text.get_window_extent(renderer).width > ellipse_width and font_size > min_font_size:
-        font_size -= decrement_step
-        temp_text.set_fontsize(font_size)
+# Final font sizes keyed by (text, ellipse width in points, font_size, min_font_size),
+# least recently used first and capped so a long-running server doesn't grow without bound
+FONT_SIZE_CACHE_SIZE = 1024
+_font_size_cache = OrderedDict()
 
-    temp_text.remove()
-    ax.text(x, y, text, ha="center", va="center", fontsize=font_size, fontweight="bold")
+def fit_text_in_ellipse(renderer, text, ellipse_width, font_size=12, min_font_size=8):
+    """
+    Returns the font size that fits the text within the ellipse, without drawing anything.
+    Text width grows linearly with font size, so a single measurement is enough.
+    """
+    # Key on the width in points, so the same label at another dpi reuses the entry
+    cache_key = (text, round(ellipse_width * 72 / renderer.dpi, 2), font_size, min_font_size)
+    if cache_key in _font_size_cache:
+        _font_size_cache.move_to_end(cache_key)
+        return _font_size_cache[cache_key]
+
+    # Fast path: plain ASCII labels short enough to fit even if every glyph were the widest one
+    if text.isascii() and renderer.points_to_pixels(len(text) * MAX_CHAR_WIDTH_EM * font_size) <= ellipse_width:
+        return font_size
+
+    ismath = is_math_text(text)
+    font = FontProperties(size=font_size, weight="bold")
+    text_width = renderer.get_text_width_height_descent(text, font, ismath)[0]
+    if text_width > ellipse_width:
+        font_size = max(min_font_size, font_size * ellipse_width / text_width)
+
+        if VERIFY_TEXT_FIT:
+            font.set_size(font_size)
+            if renderer.get_text_width_height_descent(text, font, ismath)[0] > ellipse_width:
+                warnings.warn(f"Label does not fit its ellipse at {font_size:.1f}pt: {text!r}", stacklevel=2)
+
+    _font_size_cache[cache_key] = font_size
+    if len(_font_size_cache) > FONT_SIZE_CACHE_SIZE:
+        _font_size_cache.popitem(last=False)
+    return font_size
+
+def measure_text_width(renderer, text, font_size):
+    """
+    Returns the width in pixels of the text rendered in bold at the given font size.
+    """
+    return renderer.get_text_width_height_descent(text, FontProperties(size=font_size, weight="bold"), is_math_text(text))[0]
 
 def calculate_tree_positions(nodes, edges, actor_position="top-center", width=200, height=80, spacing_factor=1.5):
     """
     Calculates tree-based positions for nodes, dynamically placing actors closest to their connected nodes.
+    Returns the positions and a dict telling whether each node carries the <<Actor>> tag, for drawing.
     """
-    actor_nodes = [node for node in nodes if "<<" in node and ">>" in node]
-    non_actor_nodes = [node for node in nodes if node not in actor_nodes]
+    # Any <<stereotype>> is laid out as an actor, but only <<Actor>> nodes are drawn as one
+    is_actor = {}
+    has_actor_tag = {}
+    for node in nodes:
+        is_actor[node] = "<<" in node and ">>" in node
+        has_actor_tag[node] = "<<Actor>>" in node
+    actor_nodes = [node for node in nodes if is_actor[node]]
+    non_actor_nodes = [node for node in nodes if not is_actor[node]]
+
+    # Outgoing adjacency, built in a single pass over the edges
+    outgoing = defaultdict(list)
+    for source, target in edges:
+        outgoing[source].append(target)
 
     # Initialize positions
     pos = {}
     x_spacing = width * spacing_factor
     y_spacing = height * spacing_factor
 
-    tree = nx.DiGraph()
-    tree.add_edges_from(edges)
+    # Level of each node reachable from an actor, via a single multi-source BFS from all actors
+    levels = {actor: 0 for actor in actor_nodes}
+    queue = deque(levels)
+    while queue:
+        node = queue.popleft()
+        for successor in outgoing[node]:
+            if successor not in levels:
+                levels[successor] = levels[node] + 1
+                queue.append(successor)
 
     if actor_position == "top-center":
         # Determine actor placement (top or bottom) based on closest connected nodes
@@ -58,7 +141,7 @@ def calculate_tree_positions(nodes, edges, actor_position="top-center", width=20
         bottom_actors = []
 
         for actor in actor_nodes:
-            connected_nodes = [target for source, target in edges if source == actor]
+            connected_nodes = outgoing[actor]
             avg_y = sum(pos.get(node, (0, 0))[1] for node in connected_nodes if node in pos) / len(connected_nodes) if connected_nodes else 0
             if avg_y >= 0:
                 top_actors.append(actor)
@@ -74,11 +157,6 @@ def calculate_tree_positions(nodes, edges, actor_position="top-center", width=20
             pos[actor] = (i * x_spacing - (len(bottom_actors) - 1) * x_spacing / 2, -len(non_actor_nodes) * y_spacing)
 
         # Position non-actor nodes
-        levels = {}
-        for actor in actor_nodes:
-            if actor in tree:
-                levels.update(nx.single_source_shortest_path_length(tree, actor))
-
         grouped_nodes = {}
         for node, level in levels.items():
             if node not in pos:
@@ -96,7 +174,7 @@ def calculate_tree_positions(nodes, edges, actor_position="top-center", width=20
         right_actors = []
 
         for actor in actor_nodes:
-            connected_nodes = [target for source, target in edges if source == actor]
+            connected_nodes = outgoing[actor]
             avg_x = sum(pos.get(node, (0, 0))[0] for node in connected_nodes if node in pos) / len(connected_nodes) if connected_nodes else 0
             if avg_x <= 0:
                 left_actors.append(actor)
@@ -112,11 +190,6 @@ def calculate_tree_positions(nodes, edges, actor_position="top-center", width=20
             pos[actor] = ((len(non_actor_nodes) + 1) * x_spacing, -i * y_spacing)
 
         # Position non-actor nodes
-        levels = {}
-        for actor in actor_nodes:
-            if actor in tree:
-                levels.update(nx.single_source_shortest_path_length(tree, actor))
-
         grouped_nodes = {}
         for node, level in levels.items():
             if node not in pos:
@@ -128,102 +201,147 @@ def calculate_tree_positions(nodes, edges, actor_position="top-center", width=20
                 y = -i * y_spacing + (len(level_nodes) - 1) * y_spacing / 2
                 pos[node] = (x, y)
 
-    return pos
+    return pos, has_actor_tag
 
-def generate_use_case_diagram(ascii_description, diagram_title, actor_position="top-center", output_format="png"):
+def generate_use_case_diagram(ascii_description, diagram_title, actor_position="top-center", output_format="png", dpi=None):
     """
     Generates a use case diagram with support for dashed and solid lines.
+    Renders at a screen-scale dpi (80) for PNG previews and a higher one (150) for PDF unless dpi is given.
     """
     edges = []
     nodes = set()
     edge_styles = {}  # Dictionary to store edge styles
 
-    for line in ascii_description.strip().split("\n"):
-        if "-->" in line:  # Dashed line
-            source, target = map(str.strip, line.split("-->"))
-            edges.append((source, target))
-            edge_styles[(source, target)] = "dashed"
-            nodes.update([source, target])
-        elif "->" in line:  # Solid line
-            source, target = map(str.strip, line.split("->"))
+    for line in iter_lines(ascii_description):
+        line = line.strip()
+        if not line:
+            continue
+
+        parts = EDGE_PATTERN.split(line, maxsplit=1)
+        if len(parts) == 3:  # Dashed (-->) or solid (->) line
+            source, arrow, target = parts[0].strip(), parts[1], parts[2].strip()
             edges.append((source, target))
-            edge_styles[(source, target)] = "solid"
+            edge_styles[(source, target)] = "dashed" if arrow == "-->" else "solid"
             nodes.update([source, target])
         else:
-            nodes.add(line.strip())
+            nodes.add(line)
 
     ellipse_width = 400  # Ellipse width in pixels
     ellipse_height = 160  # Ellipse height in pixels
-
-    pos = calculate_tree_positions(list(nodes), edges, actor_position=actor_position, width=ellipse_width, height=ellipse_height)
-
-    # Dynamically determine the figure size
-    x_positions = [x for x, y in pos.values()]
-    y_positions = [y for x, y in pos.values()]
-    figure_width = (max(x_positions) - min(x_positions) + 2 * ellipse_width) / 100  # Convert to inches
-    figure_height = (max(y_positions) - min(y_positions) + 2 * ellipse_height) / 100  # Convert to inches
-
-    plt.figure(figsize=(figure_width, figure_height), dpi=100)
-    ax = plt.gca()
-
-    # Draw the arrows first (behind ellipses)
-    for edge in edges:
-        if edge[0] in pos and edge[1] in pos:
-            # Adjusted positions for line to start and end at ellipse edges
-            (start_x, start_y), (end_x, end_y) = adjust_arrow_positions(
-                pos, edge, width=ellipse_width, height=ellipse_height
-            )
-            linestyle = "--" if edge_styles[edge] == "dashed" else "-"
-            
-            # Draw the line up to the edge of the ellipse
-            ax.plot(
-                [start_x, end_x],
-                [start_y, end_y],
-                linestyle=linestyle,
-                color="black",
-                lw=1.5,
-                zorder=1,  # Ensure it is behind ellipses
-            )
-            
-            # Add arrowhead starting exactly at the adjusted `end_x, end_y`
-            arrow_dx = end_x - start_x
-            arrow_dy = end_y - start_y
-            arrow_length = math.sqrt(arrow_dx**2 + arrow_dy**2)
-
-            # Normalize the arrow direction and scale for the arrowhead
-            arrow_dx /= arrow_length
-            arrow_dy /= arrow_length
-            ax.arrow(
-                end_x - arrow_dx * 10,  # Move back slightly for better positioning
-                end_y - arrow_dy * 10,
-                arrow_dx * 10,
-                arrow_dy * 10,
+    title_height = 0.6  # Space reserved above the diagram for the title, in inches
+    title_font_size = 18
+    min_font_size = 8  # Smallest label font size before labels are allowed to overflow their ellipse
+
+    # Layout units per inch. matplotlib's default subplot spans 77.5% of the figure width, so this keeps
+    # ellipses at the physical size they had inside those margins now that the axes fill the figure
+    units_per_inch = 100 / 0.775
+
+    if dpi is None:
+        dpi = 150 if output_format == "pdf" else 80
+
+    pos, has_actor_tag = calculate_tree_positions(list(nodes), edges, actor_position=actor_position, width=ellipse_width, height=ellipse_height)
+
+    # Dynamically determine the figure size; the width is finalized once the title and labels are measured
+    x_positions, y_positions = zip(*pos.values())
+    x_min, x_max = min(x_positions), max(x_positions)
+    y_min, y_max = min(y_positions), max(y_positions)
+    figure_height = (y_max - y_min + 2 * ellipse_height) / units_per_inch + title_height  # Convert to inches
+
+    # Only edges between positioned nodes are drawn; filter them once so the arrays below are dense
+    valid_edges = [edge for edge in edges if edge[0] in pos and edge[1] in pos]
+    sources = np.array([pos[source] for source, target in valid_edges], dtype=float).reshape(-1, 2)
+    targets = np.array([pos[target] for source, target in valid_edges], dtype=float).reshape(-1, 2)
+
+    # Adjusted positions for lines to start and end at ellipse edges
+    starts, ends, directions = adjust_arrow_positions(sources, targets, width=ellipse_width, height=ellipse_height)
+
+    # Gradio may run several requests at once, so only one may draw on the shared figure at a time
+    with _FIG_LOCK:
+        # Reuse the shared figure, resized for this diagram
+        ax = _AX
+        ax.clear()
+        _FIG.set_dpi(dpi)
+        renderer = _FIG.canvas.get_renderer()
+
+        # Size every label first, then draw them all with the shared renderer
+        labels = {node: node.replace("<<Actor>> ", "") if has_actor_tag[node] else node for node in pos}
+        ellipse_width_px = ellipse_width * dpi / units_per_inch
+        font_sizes = {node: fit_text_in_ellipse(renderer, label, ellipse_width_px, min_font_size=min_font_size) for node, label in labels.items()}
+
+        # Widen the bounds for labels that still overflow their ellipse at the minimum size,
+        # keeping the same 0.1 inch margin the title gets
+        x_left, x_right = x_min - ellipse_width, x_max + ellipse_width
+        for node, label in labels.items():
+            if font_sizes[node] <= min_font_size:
+                half_width = (measure_text_width(renderer, label, font_sizes[node]) / dpi / 2 + 0.1) * units_per_inch
+                x_left = min(x_left, pos[node][0] - half_width)
+                x_right = max(x_right, pos[node][0] + half_width)
+
+        # Widen them evenly for a title longer than the diagram, keeping a 0.1 inch margin on each side
+        title = diagram_title or "Use Case Diagram"
+        title_width = (measure_text_width(renderer, title, title_font_size) / dpi + 0.2) * units_per_inch
+        if title_width > x_right - x_left:
+            title_overflow = (title_width - (x_right - x_left)) / 2
+            x_left -= title_overflow
+            x_right += title_overflow
+
+        figure_width = (x_right - x_left) / units_per_inch  # Convert to inches
+        _FIG.set_size_inches(figure_width, figure_height)
+
+        # Let the axes fill the figure below the title, so the axis limits are the exact output bounds
+        _FIG.subplots_adjust(left=0, right=1, bottom=0, top=1 - title_height / figure_height)
+
+        # Draw the arrows first (behind ellipses)
+        solid_segments = []
+        dashed_segments = []
+        arrowheads = []
+        for edge, start, end, direction in zip(valid_edges, starts, ends, directions):
+            segments = dashed_segments if edge_styles[edge] == "dashed" else solid_segments
+            segments.append((start, end))
+
+            # Add arrowhead along the segment, ending exactly at the adjusted end point
+            arrowheads.append(FancyArrow(
+                *(end - direction * 10),  # Move back slightly for better positioning
+                *(direction * 10),
                 head_width=15,
                 head_length=15,
-                fc="black",
-                ec="black",
                 length_includes_head=True,
-                zorder=1,
-            )
-
-
-    # Draw the ellipses on top of the arrows
-    for node, (x, y) in pos.items():
-        display_text = node.replace("<<Actor>> ", "")
-        color = "lightgreen" if "<<Actor>>" in node else "lightblue"
-        ellipse = Ellipse((x, y), width=ellipse_width, height=ellipse_height, color=color, alpha=0.8, zorder=2)
-        ax.add_patch(ellipse)
-        fit_text_in_ellipse(ax, display_text, x, y, ellipse_width)
-
-    plt.title(diagram_title or "Use Case Diagram", fontsize=18, fontweight="bold")
-    plt.axis("off")
-
-    ax.set_xlim(min(x_positions) - ellipse_width, max(x_positions) + ellipse_width)
-    ax.set_ylim(min(y_positions) - ellipse_height, max(y_positions) + ellipse_height)
-
-    output_file = f"use_case_diagram.{output_format}"
-    plt.savefig(output_file, format=output_format, bbox_inches="tight")
-    plt.close()
+            ))
+
+        # Draw all lines up to the edges of the ellipses, behind the ellipses
+        ax.add_collection(LineCollection(solid_segments, colors="black", linewidths=1.5, linestyles="solid", zorder=1))
+        ax.add_collection(LineCollection(dashed_segments, colors="black", linewidths=1.5, linestyles="--", zorder=1))
+        ax.add_collection(PatchCollection(arrowheads, facecolors="black", edgecolors="black", zorder=1))
+
+        # Draw the ellipses on top of the arrows
+        node_count = len(pos)
+        colors = ["lightgreen" if has_actor_tag[node] else "lightblue" for node in pos]
+        ax.add_collection(EllipseCollection(
+            widths=np.full(node_count, ellipse_width),
+            heights=np.full(node_count, ellipse_height),
+            angles=np.zeros(node_count),
+            units="xy",
+            offsets=np.array(list(pos.values()), dtype=float).reshape(-1, 2),
+            offset_transform=ax.transData,
+            facecolors=colors,
+            edgecolors=colors,
+            alpha=0.8,
+            zorder=2,
+        ))
+
+        for node, (x, y) in pos.items():
+            ax.text(x, y, labels[node], ha="center", va="center", fontsize=font_sizes[node], fontweight="bold", zorder=3)
+
+        ax.set_title(title, fontsize=title_font_size, fontweight="bold")
+        ax.axis("off")
+
+        ax.set_xlim(x_left, x_right)
+        ax.set_ylim(y_min - ellipse_height, y_max + ellipse_height)
+
+        output_file = f"use_case_diagram.{output_format}"
+        # Fast zlib level for PNG previews; the larger file is fine for a transient download
+        save_kwargs = {"pil_kwargs": {"compress_level": 1}} if output_format == "png" else {}
+        _FIG.savefig(output_file, format=output_format, dpi=dpi, bbox_inches=None, **save_kwargs)
 
     return output_file
 